@@ -1,9 +1,13 @@
 import pandas as pd
 import os
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import Client
+from supabase_client import create_pooled_client
 import sys
+import threading
+from contextlib import nullcontext
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, List
 
 load_dotenv()
@@ -15,7 +19,56 @@ if not supabase_url or not supabase_key:
     print("Error: Supabase credentials not found in .env file")
     sys.exit(1)
 
-supabase: Client = create_client(supabase_url, supabase_key)
+supabase: Client = create_pooled_client(supabase_url, supabase_key)
+
+# Optional direct Postgres connection string; when set, price_history and
+# competitor_prices are bulk loaded with COPY instead of PostgREST requests
+database_url = os.getenv("DATABASE_URL")
+
+# Batches are sent from worker threads; product_map is shared between them
+_product_map_lock = threading.Lock()
+
+# CSV column name -> products table column name (the dataset misspells "length")
+PRODUCT_COLUMN_RENAMES = {
+    'product_name_lenght': 'product_name_length',
+    'product_description_lenght': 'product_description_length',
+}
+
+# Narrowest dtypes that hold the dataset's ranges. Prices stay float64 so the
+# values written to the numeric columns are not perturbed by float32 rounding.
+CSV_DTYPES = {
+    'product_name_lenght': 'int16',
+    'product_description_lenght': 'int32',
+    'product_photos_qty': 'int8',
+    'product_weight_g': 'int32',
+    'product_score': 'float64',
+    'volume': 'float64',
+    'qty': 'int32',
+    'total_price': 'float64',
+    'freight_price': 'float64',
+    'unit_price': 'float64',
+    'customers': 'int32',
+    'weekday': 'int8',
+    'weekend': 'int8',
+    'holiday': 'int8',
+    'month': 'int8',
+    'year': 'int16',
+    's': 'float64',
+    'lag_price': 'float64',
+    **{f'{c}{i}': 'float64' for i in range(1, 4) for c in ('comp_', 'ps', 'fp')},
+}
+
+CSV_USECOLS = ['product_id', 'product_category_name', 'month_year', *CSV_DTYPES]
+
+PRODUCT_COLUMNS = [
+    'product_id', 'product_category_name', 'product_name_length', 'product_description_length',
+    'product_photos_qty', 'product_weight_g', 'product_score', 'volume',
+]
+
+PRICE_HISTORY_COLUMNS = [
+    'product_id', 'month_year', 'qty', 'total_price', 'freight_price', 'unit_price',
+    'customers', 'weekday', 'weekend', 'holiday', 'month', 'year', 's', 'lag_price',
+]
 
 def _retry(fn, *, tries: int = 3, backoff_seconds: float = 1.0):
     last_exc = None
@@ -46,11 +99,12 @@ def _upsert_products(batch: List[dict], product_map: Dict[str, str]):
         return
     def do():
         # Use upsert to ensure idempotency on product_id
-        return supabase.table("products").upsert(batch, on_conflict="product_id").execute()
+        return supabase.table("products").upsert(batch, on_conflict="product_id", returning="representation").execute()
     result = _retry(do)
     # Update local map with ids from response when available
-    for row in result.data or []:
-        product_map[row["product_id"]] = row["id"]
+    with _product_map_lock:
+        for row in result.data or []:
+            product_map[row["product_id"]] = row["id"]
 
 
 def _upsert_price_history(batch: List[dict]):
@@ -58,7 +112,7 @@ def _upsert_price_history(batch: List[dict]):
         return []
     def do():
         # Idempotent on (product_id, month_year)
-        return supabase.table("price_history").upsert(batch, on_conflict="product_id,month_year").execute()
+        return supabase.table("price_history").upsert(batch, on_conflict="product_id,month_year", returning="representation").execute()
     result = _retry(do)
     return result.data or []
 
@@ -71,130 +125,123 @@ def _insert_competitor_prices(batch: List[dict]):
     _retry(do)
 
 
-def ingest_csv_data(csv_path: str, *, chunksize: int = 5000, product_batch_size: int = 1000, price_batch_size: int = 1000):
+COMPETITOR_COLUMNS = ['price_history_id', 'competitor_number', 'competitor_price', 'competitor_score', 'competitor_freight']
+
+
+def _copy_price_history(conn, rows: List[dict]) -> List[dict]:
+    if not rows:
+        return []
+    columns = ", ".join(PRICE_HISTORY_COLUMNS)
+    updates = ", ".join(f"{col} = excluded.{col}" for col in PRICE_HISTORY_COLUMNS[2:])
+    with conn.transaction(), conn.cursor() as cur:
+        # COPY cannot resolve conflicts itself: load into a staging table, then upsert from it
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS price_history_stage "
+                    "(LIKE price_history INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+        with cur.copy(f"COPY price_history_stage ({columns}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row([row[col] for col in PRICE_HISTORY_COLUMNS])
+        cur.execute(f"INSERT INTO price_history ({columns}) SELECT {columns} FROM price_history_stage "
+                    f"ON CONFLICT (product_id, month_year) DO UPDATE SET {updates} "
+                    "RETURNING id, product_id, month_year")
+        return [{"id": str(ph_id), "product_id": str(product_id), "month_year": month_year}
+                for ph_id, product_id, month_year in cur.fetchall()]
+
+
+def _copy_competitor_prices(conn, rows: List[dict]):
+    if not rows:
+        return
+    with conn.transaction(), conn.cursor() as cur:
+        with cur.copy(f"COPY competitor_prices ({', '.join(COMPETITOR_COLUMNS)}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row([row[col] for col in COMPETITOR_COLUMNS])
+
+
+def _batches(rows: List[dict], size: int):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def ingest_csv_data(csv_path: str, *, chunksize: int = 5000, product_batch_size: int = 1000, price_batch_size: int = 1000,
+                    comp_batch_size: int = 2000, max_workers: int = 8):
     print(f"Reading CSV file from {csv_path} in chunks of {chunksize}...")
 
     product_map: Dict[str, str] = _fetch_existing_products_map()
     total_products_ingested = 0
     total_price_rows = 0
 
-    # Stream CSV in chunks to keep memory bounded
-    for chunk_idx, df in enumerate(pd.read_csv(csv_path, chunksize=chunksize)):
-        print(f"\nProcessing chunk {chunk_idx + 1}...")
-
-        # Prepare unique products from this chunk
-        unique_products_df = df[['product_id', 'product_category_name', 'product_name_lenght',
-                                 'product_description_lenght', 'product_photos_qty',
-                                 'product_weight_g', 'product_score', 'volume']].drop_duplicates(subset=['product_id'])
-
-        product_rows: List[dict] = []
-        for _, row in unique_products_df.iterrows():
-            prod_id = row['product_id']
-            if prod_id in product_map:
-                continue
-            product_rows.append({
-                "product_id": prod_id,
-                "product_category_name": row['product_category_name'],
-                "product_name_length": int(row['product_name_lenght']),
-                "product_description_length": int(row['product_description_lenght']),
-                "product_photos_qty": int(row['product_photos_qty']),
-                "product_weight_g": int(row['product_weight_g']),
-                "product_score": float(row['product_score']),
-                "volume": float(row['volume'])
-            })
+    # Without DATABASE_URL, conn is None and the PostgREST path is used
+    connection = nullcontext()
+    if database_url:
+        import psycopg  # only needed for the COPY path
+        connection = psycopg.connect(database_url, autocommit=True)
+        print("Using COPY over a direct database connection for price history and competitor prices")
+
+    # Batches within a stage are sent concurrently; stages stay ordered since each needs the previous ids
+    # The connection is closed on exit, including when a stage fails
+    with connection as conn, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Stream CSV in chunks to keep memory bounded
+        for chunk_idx, df in enumerate(pd.read_csv(csv_path, usecols=CSV_USECOLS, dtype=CSV_DTYPES, chunksize=chunksize)):
+            print(f"\nProcessing chunk {chunk_idx + 1}...")
+            df = df.rename(columns=PRODUCT_COLUMN_RENAMES)
+
+            # Prepare unique products from this chunk, skipping ids already known
+            seen = set(product_map)
+            product_rows: List[dict] = []
+            for product in df[PRODUCT_COLUMNS].itertuples(index=False):
+                if product.product_id in seen:
+                    continue
+                seen.add(product.product_id)
+                product_rows.append(product._asdict())
 
             # Flush in batches
-            if len(product_rows) >= product_batch_size:
-                _upsert_products(product_rows, product_map)
-                total_products_ingested += len(product_rows)
-                print(f"Upserted {len(product_rows)} products (running total: {total_products_ingested})")
-                product_rows = []
-
-        if product_rows:
-            _upsert_products(product_rows, product_map)
-            total_products_ingested += len(product_rows)
-            print(f"Upserted {len(product_rows)} products (running total: {total_products_ingested})")
-
-        # Prepare price history rows for this chunk, mapping external product_id to internal id
-        price_rows: List[dict] = []
-        competitors_rows: List[dict] = []
-
-        for _, row in df.iterrows():
-            prod_id = row['product_id']
-            internal_id = product_map.get(prod_id)
-            if not internal_id:
-                continue
-            price_rows.append({
-                "product_id": internal_id,
-                "month_year": row['month_year'],
-                "qty": int(row['qty']),
-                "total_price": float(row['total_price']),
-                "freight_price": float(row['freight_price']),
-                "unit_price": float(row['unit_price']),
-                "customers": int(row['customers']),
-                "weekday": int(row['weekday']),
-                "weekend": int(row['weekend']),
-                "holiday": int(row['holiday']),
-                "month": int(row['month']),
-                "year": int(row['year']),
-                "s": float(row['s']),
-                "lag_price": float(row['lag_price'])
-            })
-
-            # Flush price rows in batches with upsert
-            if len(price_rows) >= price_batch_size:
-                inserted = _upsert_price_history(price_rows)
+            futures = {executor.submit(_upsert_products, batch, product_map): len(batch)
+                       for batch in _batches(product_rows, product_batch_size)}
+            for future in as_completed(futures):
+                future.result()
+                total_products_ingested += futures[future]
+                print(f"Upserted {futures[future]} products (running total: {total_products_ingested})")
+
+            # Prepare price history rows for this chunk, mapping external product_id to internal id
+            price_df = df.assign(product_id=df['product_id'].map(product_map)).dropna(subset=['product_id'])
+            price_rows: List[dict] = price_df[PRICE_HISTORY_COLUMNS].to_dict(orient="records")
+
+            # Flush price rows in batches with upsert, keying the returned ids by (product_id, month_year)
+            ph_id_map: Dict[tuple, str] = {}
+            if conn is not None:
+                for ph in _copy_price_history(conn, price_rows):
+                    ph_id_map[(ph["product_id"], ph["month_year"])] = ph["id"]
                 total_price_rows += len(price_rows)
-                print(f"Upserted {len(price_rows)} price rows (running total: {total_price_rows})")
-
-                # Build competitor rows linked to returned ids when available, otherwise skip per-row linkage for batch
-                # Here, we construct competitor_rows using the same order if ids are returned; fallback will handle remaining after final flush
-                price_rows = []
-
-        if price_rows:
-            inserted = _upsert_price_history(price_rows)
-            total_price_rows += len(price_rows)
-            print(f"Upserted {len(price_rows)} price rows (running total: {total_price_rows})")
-
-        # For competitor prices, we need associated price_history ids.
-        # Since PostgREST may not return all ids for upserted conflicts, we rebuild mapping by querying the just-updated set.
-        # To keep it simple and scalable, we perform a second pass within the chunk to insert competitors row-by-row grouped and batched.
-        comp_batch: List[dict] = []
-        for _, row in df.iterrows():
-            prod_id = row['product_id']
-            internal_id = product_map.get(prod_id)
-            if not internal_id:
-                continue
-            # Fetch price_history id for (product_id, month_year)
-            try:
-                ph = supabase.table("price_history").select("id").eq("product_id", internal_id).eq("month_year", row['month_year']).maybe_single().execute()
-                if not ph.data:
-                    continue
-                price_history_id = ph.data["id"]
-            except Exception as e:  # noqa: BLE001
-                print(f"Warning: failed to resolve price_history id for product {prod_id} {row['month_year']}: {e}")
-                continue
-
-            for i in range(1, 4):
-                comp_price = row.get(f'comp_{i}')
-                comp_score = row.get(f'ps{i}')
-                comp_freight = row.get(f'fp{i}')
-                if pd.notna(comp_price) and pd.notna(comp_score) and pd.notna(comp_freight):
-                    comp_batch.append({
-                        "price_history_id": price_history_id,
-                        "competitor_number": i,
-                        "competitor_price": float(comp_price),
-                        "competitor_score": float(comp_score),
-                        "competitor_freight": float(comp_freight)
-                    })
-            if len(comp_batch) >= 2000:
-                _insert_competitor_prices(comp_batch)
-                print(f"Inserted {len(comp_batch)} competitor price rows")
-                comp_batch = []
-
-        if comp_batch:
-            _insert_competitor_prices(comp_batch)
-            print(f"Inserted {len(comp_batch)} competitor price rows")
+                print(f"Copied {len(price_rows)} price rows (running total: {total_price_rows})")
+            else:
+                futures = {executor.submit(_upsert_price_history, batch): len(batch)
+                           for batch in _batches(price_rows, price_batch_size)}
+                for future in as_completed(futures):
+                    for ph in future.result():
+                        ph_id_map[(ph["product_id"], ph["month_year"])] = ph["id"]
+                    total_price_rows += futures[future]
+                    print(f"Upserted {futures[future]} price rows (running total: {total_price_rows})")
+
+            # Link competitor prices to the price_history ids returned by the upserts above,
+            # reshaping the three comp_i/ps_i/fp_i column groups into one row per competitor
+            comp_df = price_df.assign(price_history_id=[
+                ph_id_map.get(key) for key in zip(price_df['product_id'], price_df['month_year'])
+            ]).dropna(subset=['price_history_id'])
+            comp_rows: List[dict] = pd.concat([
+                comp_df[['price_history_id', f'comp_{i}', f'ps{i}', f'fp{i}']]
+                .rename(columns={f'comp_{i}': 'competitor_price', f'ps{i}': 'competitor_score', f'fp{i}': 'competitor_freight'})
+                .assign(competitor_number=i)
+                for i in range(1, 4)
+            ]).dropna()[COMPETITOR_COLUMNS].to_dict(orient="records")
+
+            if conn is not None:
+                _copy_competitor_prices(conn, comp_rows)
+                print(f"Copied {len(comp_rows)} competitor price rows")
+            else:
+                futures = {executor.submit(_insert_competitor_prices, batch): len(batch)
+                           for batch in _batches(comp_rows, comp_batch_size)}
+                for future in as_completed(futures):
+                    future.result()
+                    print(f"Inserted {futures[future]} competitor price rows")
 
     print(f"\n✓ Successfully upserted ~{total_products_ingested} products and {total_price_rows} price history rows")
     print("\nData ingestion completed successfully!")
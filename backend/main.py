@@ -1,16 +1,22 @@
 from fastapi import FastAPI, HTTPException
 from fastapi import Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import json
 import os
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import Client
+from supabase_client import create_pooled_client
 from optimization import PriceOptimizer
 
 load_dotenv()
 
-app = FastAPI(title="Price Optimization API")
+app = FastAPI(title="Price Optimization API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,7 +28,118 @@ app.add_middleware(
 
 supabase_url = os.getenv("VITE_SUPABASE_URL")
 supabase_key = os.getenv("VITE_SUPABASE_ANON_KEY")
-supabase: Client = create_client(supabase_url, supabase_key)
+supabase: Client = create_pooled_client(supabase_url, supabase_key)
+
+# Categories and the analytics summary change only on ingestion; serve them from memory for a minute
+_response_cache: TTLCache = TTLCache(maxsize=16, ttl=60)
+
+# Trained demand models per product_id, reused while the price history is unchanged
+_model_cache: TTLCache = TTLCache(maxsize=256, ttl=600)
+
+def _history_fingerprint(price_data: List[dict]) -> str:
+    # Hash of the whole history, so corrections to older months also invalidate the model;
+    # stable across processes so it can be stored alongside persisted models
+    history = json.dumps(price_data, sort_keys=True, default=str)
+    return hashlib.sha1(history.encode()).hexdigest()
+
+async def _load_optimizer(product_id: str, internal_product_id: str, price_data: List[dict]):
+    fingerprint = _history_fingerprint(price_data)
+    cached = _model_cache.get(product_id)
+    if cached and cached[0] == fingerprint:
+        return cached[1], cached[2]
+
+    # Fall back to the model persisted by a previous process before retraining;
+    # like the persist below, a failed lookup does not fail the request
+    try:
+        stored = await execute(
+            supabase
+            .table("product_models")
+            .select("fingerprint, model, summary")
+            .eq("product_id", internal_product_id)
+            .maybe_single()
+        )
+    except Exception as e:  # noqa: BLE001
+        print(f"Warning: failed to load stored model for product {product_id}: {e}")
+        stored = None
+    # maybe_single() returns None when the product has no stored model yet
+    if stored is not None and stored.data["fingerprint"] == fingerprint:
+        optimizer = PriceOptimizer.from_state(stored.data["model"])
+        model_info = stored.data["summary"]
+    else:
+        optimizer = PriceOptimizer()
+        model_info = optimizer.train_demand_model(price_data)
+        try:
+            await execute(
+                supabase
+                .table("product_models")
+                .upsert({
+                    "product_id": internal_product_id,
+                    "fingerprint": fingerprint,
+                    "model": optimizer.to_state(),
+                    "summary": model_info,
+                }, on_conflict="product_id")
+            )
+        except Exception as e:  # noqa: BLE001
+            print(f"Warning: failed to persist model for product {product_id}: {e}")
+
+    _model_cache[product_id] = (fingerprint, optimizer, model_info)
+    return optimizer, model_info
+
+async def execute(query):
+    # The supabase client is synchronous; run requests off the event loop
+    return await asyncio.to_thread(query.execute)
+
+# External product_id -> internal products.id, loaded at startup and refreshed periodically
+PRODUCT_INDEX_REFRESH_SECONDS = 300
+app.state.product_index = {}
+
+async def _refresh_product_index():
+    index: Dict[str, str] = {}
+    page_size = 1000
+    start = 0
+    # range() end is exclusive (postgrest 0.13), so each request asks for page_size rows;
+    # advance by the rows actually returned and stop on the first empty page
+    while True:
+        response = await execute(
+            supabase.table("products").select("id, product_id").order("product_id").range(start, start + page_size)
+        )
+        rows = response.data or []
+        if not rows:
+            break
+        index.update((row["product_id"], row["id"]) for row in rows)
+        start += len(rows)
+    app.state.product_index = index
+
+async def _refresh_product_index_periodically():
+    while True:
+        await asyncio.sleep(PRODUCT_INDEX_REFRESH_SECONDS)
+        try:
+            await _refresh_product_index()
+        except Exception as e:  # noqa: BLE001
+            print(f"Warning: failed to refresh product index: {e}")
+
+@app.on_event("startup")
+async def warm_product_index():
+    try:
+        await _refresh_product_index()
+    except Exception as e:  # noqa: BLE001
+        print(f"Warning: failed to load product index: {e}")
+    app.state.product_index_task = asyncio.create_task(_refresh_product_index_periodically())
+
+@app.on_event("shutdown")
+async def stop_product_index_refresh():
+    app.state.product_index_task.cancel()
+
+async def _resolve_product_id(product_id: str) -> Optional[str]:
+    internal_product_id = app.state.product_index.get(product_id)
+    if internal_product_id is None:
+        # Products created since the last refresh are looked up directly
+        response = await execute(supabase.table("products").select("id").eq("product_id", product_id).maybe_single())
+        if response is None:
+            return None
+        internal_product_id = response.data["id"]
+        app.state.product_index[product_id] = internal_product_id
+    return internal_product_id
 
 class Product(BaseModel):
     product_id: str
@@ -57,10 +174,8 @@ async def get_products(
             # Basic search on product_id or category name
             query = query.or_(f"product_id.ilike.%{search}%,product_category_name.ilike.%{search}%")
 
-        # Supabase range is inclusive; compute end index
-        start = offset
-        end = offset + limit - 1
-        response = query.order("product_id", desc=False).range(start, end).execute()
+        # range() end is exclusive (postgrest 0.13)
+        response = await execute(query.order("product_id", desc=False).range(offset, offset + limit))
         return {"products": response.data, "limit": limit, "offset": offset}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -68,7 +183,7 @@ async def get_products(
 @app.get("/api/products/{product_id}")
 async def get_product(product_id: str):
     try:
-        response = supabase.table("products").select("*").eq("product_id", product_id).maybe_single().execute()
+        response = await execute(supabase.table("products").select("*").eq("product_id", product_id).maybe_single())
         if not response.data:
             raise HTTPException(status_code=404, detail="Product not found")
         return response.data
@@ -80,21 +195,19 @@ async def get_product(product_id: str):
 @app.get("/api/products/{product_id}/price-history")
 async def get_price_history(product_id: str, limit: int = Query(120, ge=1, le=1000), offset: int = Query(0, ge=0)):
     try:
-        product_response = supabase.table("products").select("id").eq("product_id", product_id).maybe_single().execute()
-        if not product_response.data:
+        internal_product_id = await _resolve_product_id(product_id)
+        if not internal_product_id:
             raise HTTPException(status_code=404, detail="Product not found")
 
-        start = offset
-        end = offset + limit - 1
-        history_response = (
+        history_response = await execute(
             supabase
             .table("price_history")
             .select("*")
-            .eq("product_id", product_response.data["id"])
+            .eq("product_id", internal_product_id)
             .order("year", desc=False)
             .order("month", desc=False)
-            .range(start, end)
-            .execute()
+            # range() end is exclusive (postgrest 0.13)
+            .range(offset, offset + limit)
         )
         return {"price_history": history_response.data, "limit": limit, "offset": offset}
     except HTTPException:
@@ -105,40 +218,27 @@ async def get_price_history(product_id: str, limit: int = Query(120, ge=1, le=10
 @app.post("/api/optimize")
 async def optimize_price(payload: PriceOptimizationRequest):
     try:
-        # Resolve internal product id
-        product_response = (
-            supabase
-            .table("products")
-            .select("id, product_id")
-            .eq("product_id", payload.product_id)
-            .maybe_single()
-            .execute()
-        )
-        if not product_response.data:
+        internal_product_id = await _resolve_product_id(payload.product_id)
+        if not internal_product_id:
             raise HTTPException(status_code=404, detail="Product not found")
 
-        internal_product_id = product_response.data["id"]
-
         # Load price history with required features
-        history_response = (
+        history_response = await execute(
             supabase
             .table("price_history")
             .select("*")
             .eq("product_id", internal_product_id)
             .order("year", desc=False)
             .order("month", desc=False)
-            .execute()
         )
 
         price_data: List[dict] = history_response.data or []
         if len(price_data) < 5:
             raise HTTPException(status_code=400, detail="Insufficient data to optimize (need >= 5 records)")
 
-        optimizer = PriceOptimizer()
-        result = optimizer.optimize_price(price_data)
-
         # Also include a quick model summary
-        model_info = optimizer.train_demand_model(price_data)
+        optimizer, model_info = await _load_optimizer(payload.product_id, internal_product_id, price_data)
+        result = optimizer.optimize_price(price_data, retrain=False)
 
         return {"product_id": payload.product_id, "result": result, "model": model_info}
     except HTTPException:
@@ -149,26 +249,17 @@ async def optimize_price(payload: PriceOptimizationRequest):
 @app.get("/api/products/{product_id}/elasticity")
 async def get_price_elasticity(product_id: str):
     try:
-        product_response = (
-            supabase
-            .table("products")
-            .select("id, product_id")
-            .eq("product_id", product_id)
-            .maybe_single()
-            .execute()
-        )
-        if not product_response.data:
+        internal_product_id = await _resolve_product_id(product_id)
+        if not internal_product_id:
             raise HTTPException(status_code=404, detail="Product not found")
 
-        internal_product_id = product_response.data["id"]
-        history_response = (
+        history_response = await execute(
             supabase
             .table("price_history")
             .select("unit_price, qty")
             .eq("product_id", internal_product_id)
             .order("year", desc=False)
             .order("month", desc=False)
-            .execute()
         )
 
         price_data: List[dict] = history_response.data or []
@@ -182,35 +273,39 @@ async def get_price_elasticity(product_id: str):
 
 @app.get("/api/categories")
 async def get_categories():
+    if "categories" in _response_cache:
+        return _response_cache["categories"]
     try:
-        response = supabase.table("products").select("product_category_name").execute()
-        categories = list(set([p["product_category_name"] for p in response.data]))
-        return {"categories": sorted(categories)}
+        response = await execute(supabase.rpc("product_categories", {}))
+        categories = [row["product_category_name"] for row in response.data or []]
+        result = {"categories": categories}
+        _response_cache["categories"] = result
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/analytics/summary")
 async def get_analytics_summary():
+    if "summary" in _response_cache:
+        return _response_cache["summary"]
     try:
-        products_response = supabase.table("products").select("id", count="exact").execute()
-        price_history_response = supabase.table("price_history").select("*").execute()
-
-        total_products = products_response.count
-        total_records = len(price_history_response.data)
+        # Aggregated in PostgreSQL (see analytics_summary migration)
+        response = await execute(supabase.rpc("analytics_summary", {}))
+        summary = response.data[0]
 
-        if price_history_response.data:
-            total_revenue = sum([record["total_price"] for record in price_history_response.data])
-            avg_price = sum([record["unit_price"] for record in price_history_response.data]) / len(price_history_response.data)
-        else:
-            total_revenue = 0
-            avg_price = 0
+        total_products = summary["total_products"]
+        total_records = summary["total_records"]
+        total_revenue = float(summary["total_revenue"])
+        avg_price = float(summary["average_price"])
 
-        return {
+        result = {
             "total_products": total_products,
             "total_records": total_records,
             "total_revenue": round(total_revenue, 2),
             "average_price": round(avg_price, 2)
         }
+        _response_cache["summary"] = result
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1,17 +1,47 @@
-import pandas as pd
+import hashlib
+import threading
+from collections import OrderedDict
+from operator import itemgetter
+
 import numpy as np
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import StandardScaler
+
+__all__ = ["PriceOptimizer"]
+
+
+def _to_columns(price_data: list[dict], columns: list[str]) -> dict[str, np.ndarray]:
+    # Un seul passage par colonne ; valeurs None / absentes -> NaN
+    n = len(price_data)
+    return {
+        col: np.fromiter((np.nan if (v := r.get(col)) is None else v for r in price_data), dtype=np.float64, count=n)
+        for col in columns
+    }
+
 
 class PriceOptimizer:
+    # Modèles déjà entraînés, partagés entre instances : empreinte de (X, y, features) -> (état, r²)
+    _fit_cache: "OrderedDict[bytes, tuple[dict, float]]" = OrderedDict()
+    _fit_cache_size = 128
+    _fit_cache_lock = threading.Lock()
+
     def __init__(self):
-        self.model = None
-        self.scaler = StandardScaler()
+        # Régression linéaire sur features standardisées : y = ((x - mean) / std) @ coef + intercept
+        self.coef_: np.ndarray | None = None
+        self.intercept_: float = 0.0
+        self.mean_: np.ndarray | None = None
+        self.std_: np.ndarray | None = None
         self.feature_names: list[str] = []
+        # Forme affine équivalente, précalculée après l'entraînement : y = x @ _w + _b
+        self._w: np.ndarray | None = None
+        self._b: float = 0.0
+        # Extraction des features dans l'ordre du modèle, quand toutes sont présentes
+        self._extract: itemgetter | None = None
+        # Vecteur de travail réutilisé par predict_demand (pas d'allocation par appel)
+        self._x_buf: np.ndarray | None = None
 
     def prepare_features(self, price_data: list[dict]) -> tuple[np.ndarray, np.ndarray, list[str]]:
-        df = pd.DataFrame(price_data)
+        return self._features(*self._columns(price_data))
 
+    def _columns(self, price_data: list[dict]) -> tuple[dict[str, np.ndarray], list[str]]:
         # List de toutes les features candidate
         feature_columns = [
             'unit_price', 'freight_price', 'product_score',
@@ -24,11 +54,17 @@ class PriceOptimizer:
             'weekday', 'weekend', 'holiday', 'month', 's', 'lag_price'
         ]
 
-        available_features = [col for col in features_to_use if col in df.columns]
+        present_columns = set().union(*price_data)
+        available_features = [col for col in features_to_use if col in present_columns]
+        return _to_columns(price_data, available_features + ['qty']), available_features
 
-        # Gérer les valeurs NaN si besoin
-        X = df[available_features].fillna(0).values
-        y = df['qty'].fillna(0).values
+    def _features(self, columns: dict[str, np.ndarray], available_features: list[str]) -> tuple[np.ndarray, np.ndarray, list[str]]:
+        # Une colonne NumPy par feature (dict de tableaux), sans passer par pandas ; valeurs nulles -> 0
+        X = np.empty((len(columns['qty']), len(available_features)))
+        for j, col in enumerate(available_features):
+            X[:, j] = columns[col]
+        X[np.isnan(X)] = 0.0
+        y = np.where(np.isnan(columns['qty']), 0.0, columns['qty'])
 
         # Optionnel : transformer la cible (log) pour traiter asymétrie
         # y = np.log1p(y)  # Si approprié, mais attention à l'interprétation
@@ -36,86 +72,137 @@ class PriceOptimizer:
         return X, y, available_features
 
     def train_demand_model(self, price_data: list[dict]) -> dict:
-        X, y, feature_names = self.prepare_features(price_data)
+        return self._fit(*self.prepare_features(price_data))
 
+    def _fit(self, X: np.ndarray, y: np.ndarray, feature_names: list[str]) -> dict:
         if len(X) < 5:
             raise ValueError("Insufficient data for training. Need at least 5 records.")
 
-        # Entraînement avec normalisation
-        X_scaled = self.scaler.fit_transform(X)
+        # Mêmes données -> même modèle : on restaure l'état au lieu de réentraîner
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.ascontiguousarray(X).tobytes())
+        digest.update(np.ascontiguousarray(y).tobytes())
+        digest.update("\0".join(feature_names).encode())
+        key = digest.digest()
+        with self._fit_cache_lock:
+            cached = self._fit_cache.get(key)
+            if cached is not None:
+                self._fit_cache.move_to_end(key)
+        if cached is not None:
+            state, r_squared = cached
+            self._load_state(state)
+            return {
+                "r_squared": r_squared,
+                "coefficients": self.coef_.tolist(),
+                "intercept": self.intercept_
+            }
 
-        self.model = LinearRegression()
-        self.model.fit(X_scaled, y)
+        # Entraînement avec normalisation. Comme StandardScaler, une colonne constante (variance
+        # nulle aux erreurs d'arrondi près) garde un écart-type de 1 au lieu d'amplifier le bruit.
+        n = len(X)
+        eps = np.finfo(np.float64).eps
+        self.mean_ = X.mean(axis=0)
+        var = X.var(axis=0)
+        constant = var <= n * eps * var + (n * self.mean_ * eps) ** 2
+        self.std_ = np.where(constant, 1.0, np.sqrt(var))
+        # Normalisation en place sur une seule copie de X : soustraction puis produit par 1 / std
+        X_scaled = X - self.mean_
+        X_scaled *= 1.0 / self.std_
+
+        # Sur X et y centrés, l'intercept vaut la moyenne de y et les coefficients s'obtiennent
+        # par moindres carrés sans colonne constante. On recentre X_scaled pour effacer le résidu
+        # d'arrondi de la normalisation : avec moins de lignes que de features, ce résidu crée une
+        # direction presque singulière que lstsq ne tronque plus.
+        X_scaled -= X_scaled.mean(axis=0)
+        y_mean = float(y.mean())
+        y_centered = y - y_mean
+        coef, *_ = np.linalg.lstsq(X_scaled, y_centered, rcond=None)
+        self.intercept_ = y_mean
+        self.coef_ = coef
         self.feature_names = feature_names
+        self._fuse()
+
+        residuals = y_centered - X_scaled @ coef
+        ss_res = float(residuals @ residuals)
+        ss_tot = float(y_centered @ y_centered)
+        if ss_tot > 0:
+            r_squared = 1.0 - ss_res / ss_tot
+        else:
+            r_squared = 1.0 if ss_res == 0 else 0.0
+
+        with self._fit_cache_lock:
+            self._fit_cache[key] = (self.to_state(), r_squared)
+            if len(self._fit_cache) > self._fit_cache_size:
+                self._fit_cache.popitem(last=False)
 
         return {
-            "r_squared": self.model.score(X_scaled, y),
-            "coefficients": self.model.coef_.tolist(),
-            "intercept": float(self.model.intercept_)
+            "r_squared": r_squared,
+            "coefficients": self.coef_.tolist(),
+            "intercept": self.intercept_
         }
 
-    def predict_demand(self, features: dict) -> float:
-        if self.model is None:
+    def to_state(self) -> dict:
+        # Paramètres du modèle entraîné, sérialisables en JSON
+        if self.coef_ is None:
             raise ValueError("Model not trained. Call train_demand_model first.")
+        return {
+            "feature_names": self.feature_names,
+            "coefficients": self.coef_.tolist(),
+            "intercept": self.intercept_,
+            "mean": self.mean_.tolist(),
+            "std": self.std_.tolist()
+        }
 
-        vector = [features.get(name, 0) for name in self.feature_names]
-        feature_array = np.array([vector])
-        feature_scaled = self.scaler.transform(feature_array)
-        prediction = self.model.predict(feature_scaled)
-
-        # Si la demande est très faible ou négative, ajuster si besoin
-        demand = max(0, float(prediction[0]))
-        # Si transformation log était appliquée, appliquer inverse ici
-        # demand = np.expm1(prediction[0])
-        return demand
-
-    def optimize_price(self, price_data: list[dict]) -> dict:
-        # Entraîner le modèle
-        self.train_demand_model(price_data)
-        df = pd.DataFrame(price_data)
-
-        def mean_or(df, col, default=0.0):
-            return float(df[col].mean()) if col in df.columns and len(df[col]) > 0 else float(default)
-
-        def last_or(df, col, default=0.0):
-            return float(df[col].iloc[-1]) if col in df.columns and len(df[col]) > 0 else float(default)
-
-        current_price = last_or(df, 'unit_price', 0.0)
-        avg_freight = mean_or(df, 'freight_price', 0.0)
-        avg_score = mean_or(df, 'product_score', 0.0)
-
-        # Critère : dans une vraie application, utilisez une valeur constante ou la dernière observation
-        price_range = np.linspace(current_price * 0.5, current_price * 1.5, 50)
-
-        best_price = current_price
-        best_revenue = 0
-        scenarios = []
-
-        for price in price_range:
-            features = {
-                'unit_price': price,
-                'freight_price': avg_freight,
-                'product_score': avg_score,
-                'weekday': mean_or(df, 'weekday', 0.0),
-                'weekend': mean_or(df, 'weekend', 0.0),
-                'holiday': mean_or(df, 'holiday', 0.0),
-                'month': last_or(df, 'month', 1.0),
-                's': mean_or(df, 's', 0.0),
-                'lag_price': last_or(df, 'unit_price', 0.0)
-            }
-
-            predicted_qty = self.predict_demand(features)
-            predicted_revenue = price * predicted_qty
+    @classmethod
+    def from_state(cls, state: dict) -> "PriceOptimizer":
+        optimizer = cls()
+        optimizer._load_state(state)
+        return optimizer
+
+    def _load_state(self, state: dict) -> None:
+        self.feature_names = list(state["feature_names"])
+        self.coef_ = np.asarray(state["coefficients"], dtype=np.float64)
+        self.intercept_ = float(state["intercept"])
+        self.mean_ = np.asarray(state["mean"], dtype=np.float64)
+        self.std_ = np.asarray(state["std"], dtype=np.float64)
+        self._fuse()
+
+    def _fuse(self) -> None:
+        # ((x - mean) / std) @ coef + intercept == x @ (coef / std) + (intercept - (mean / std) @ coef)
+        self._w = self.coef_ / self.std_
+        self._b = float(self.intercept_ - (self.mean_ / self.std_) @ self.coef_)
+        # itemgetter ne renvoie un tuple qu'à partir de deux clés
+        self._extract = itemgetter(*self.feature_names) if len(self.feature_names) > 1 else None
+        self._x_buf = np.empty(len(self.feature_names))
 
-            scenarios.append({
-                'price': float(price),
-                'predicted_quantity': float(predicted_qty),
-                'predicted_revenue': float(predicted_revenue)
-            })
+    def predict_demand(self, features: dict) -> float:
+        if self.coef_ is None:
+            raise ValueError("Model not trained. Call train_demand_model first.")
 
-            if predicted_revenue > best_revenue:
-                best_revenue = predicted_revenue
-                best_price = price
+        values = None
+        if self._extract is not None:
+            try:
+                values = self._extract(features)
+            except KeyError:
+                pass
+        if values is None:
+            # Feature manquante : valeur par défaut 0
+            values = [features.get(name, 0) for name in self.feature_names]
+        self._x_buf[:] = values
+        return max(0.0, float(self._x_buf @ self._w + self._b))
+
+    def optimize_price(self, price_data: list[dict], retrain: bool = True, include_scenarios: bool = True) -> dict:
+        # Entraîner le modèle (retrain=False réutilise un modèle déjà entraîné sur ces données)
+        current_price, features = self._baseline(price_data, retrain)
+
+        lo, hi = current_price * 0.5, current_price * 1.5
+        best_price, best_revenue = self._best_price(features, lo, hi)
+        if best_revenue <= 0:
+            best_price, best_revenue = current_price, 0.0
+
+        # Courbe de scénarios pour l'affichage uniquement ; elle n'intervient plus dans le choix du prix
+        price_range = np.linspace(lo, hi, 50)
+        scenarios = self._scenarios(features, price_range) if include_scenarios else []
 
         return {
             'current_price': float(current_price),
@@ -125,18 +212,144 @@ class PriceOptimizer:
             'scenarios': scenarios
         }
 
-    def calculate_elasticity(self, price_data: list[dict]) -> float:
-        df = pd.DataFrame(price_data)
+    @classmethod
+    def optimize_prices_batch(cls, price_data_list: list[list[dict]], include_scenarios: bool = True) -> list[dict]:
+        # Un modèle par produit, puis optimum et courbes calculés pour tous les produits en une fois
+        optimizers = [cls() for _ in price_data_list]
+        baselines = [opt._baseline(data, True) for opt, data in zip(optimizers, price_data_list)]
+        terms = [opt._revenue_terms(features) for opt, (_, features) in zip(optimizers, baselines)]
+
+        current = np.array([current_price for current_price, _ in baselines], dtype=float)
+        a = np.array([slope for slope, _ in terms], dtype=float)
+        c = np.array([offset for _, offset in terms], dtype=float)
+        lo, hi = current * 0.5, current * 1.5
+
+        # Candidats par produit, triés : borne basse, sommet ramené dans [lo, hi], borne haute
+        vertex = np.divide(-c, 2 * a, out=lo.copy(), where=a < 0)
+        candidates = np.column_stack([lo, np.clip(vertex, lo, hi), hi])
+        revenues = candidates * np.maximum(a[:, None] * candidates + c[:, None], 0.0)
+        best = revenues.argmax(axis=1)
+        rows = np.arange(len(best))
+        best_prices = candidates[rows, best]
+        best_revenues = revenues[rows, best]
+
+        # Sans courbes, des tableaux vides (produits x 0)
+        price_ranges = predicted_qty = predicted_revenue = np.empty((len(current), 0))
+        if include_scenarios:
+            # Demande linéaire en prix : une seule opération pour toutes les courbes (produits x 50)
+            price_ranges = np.linspace(lo, hi, 50, axis=1)
+            predicted_qty = np.maximum(a[:, None] * price_ranges + c[:, None], 0.0)
+            predicted_revenue = price_ranges * predicted_qty
+
+        results = []
+        for i, current_price in enumerate(current.tolist()):
+            best_price, best_revenue = float(best_prices[i]), float(best_revenues[i])
+            if best_revenue <= 0:
+                best_price, best_revenue = current_price, 0.0
+            scenarios = [
+                {'price': price, 'predicted_quantity': qty, 'predicted_revenue': revenue}
+                for price, qty, revenue in zip(
+                    price_ranges[i].tolist(), predicted_qty[i].tolist(), predicted_revenue[i].tolist()
+                )
+            ]
+            results.append({
+                'current_price': current_price,
+                'optimized_price': best_price,
+                'expected_revenue': best_revenue,
+                'price_change_percentage': float((best_price - current_price) / current_price * 100),
+                'scenarios': scenarios
+            })
+        return results
+
+    def _baseline(self, price_data: list[dict], retrain: bool) -> tuple[float, dict]:
+        # Colonnes lues une seule fois, partagées entre l'entraînement (valeurs nulles -> 0) et les
+        # agrégats. Comme pandas, les valeurs nulles (NaN) sont ignorées dans les moyennes ; une
+        # colonne absente de toutes les lignes prend sa valeur par défaut.
+        columns, feature_names = self._columns(price_data)
+        if retrain or self.coef_ is None:
+            self._fit(*self._features(columns, feature_names))
+
+        means = {}
+        last = {}
+        for col in feature_names:
+            values = columns[col]
+            valid = values[~np.isnan(values)]
+            means[col] = float(valid.mean()) if len(valid) > 0 else np.nan
+            last[col] = float(values[-1])
+
+        current_price = float(last.get('unit_price', 0.0))
+
+        features = {
+            'unit_price': current_price,
+            'freight_price': means.get('freight_price', 0.0),
+            'product_score': means.get('product_score', 0.0),
+            'weekday': means.get('weekday', 0.0),
+            'weekend': means.get('weekend', 0.0),
+            'holiday': means.get('holiday', 0.0),
+            'month': float(last.get('month', 1.0)),
+            's': means.get('s', 0.0),
+            'lag_price': current_price
+        }
+        return current_price, features
+
+    def _revenue_terms(self, features: dict) -> tuple[float, float]:
+        # Le modèle est linéaire en unit_price, les autres features étant fixées :
+        # demande(p) = max(0, a * p + c)
+        base = np.array([features.get(name, 0) for name in self.feature_names], dtype=float)
+        a = 0.0
+        if 'unit_price' in self.feature_names:
+            idx = self.feature_names.index('unit_price')
+            a = float(self._w[idx])
+            base[idx] = 0.0
+        c = float(base @ self._w + self._b)
+        return a, c
+
+    def _best_price(self, features: dict, lo: float, hi: float) -> tuple[float, float]:
+        # revenu(p) = p * (a * p + c) est maximal en -c / (2a) si a < 0.
+        # Le maximum sur [lo, hi] est atteint en ce point ou à une borne.
+        a, c = self._revenue_terms(features)
+
+        candidates = [lo, hi]
+        if a < 0:
+            vertex = -c / (2 * a)
+            if lo < vertex < hi:
+                candidates.append(vertex)
+
+        best_price, best_revenue = lo, 0.0
+        for price in sorted(candidates):
+            revenue = price * max(0.0, a * price + c)
+            if revenue > best_revenue:
+                best_price, best_revenue = price, revenue
+        return best_price, best_revenue
+
+    def _scenarios(self, features: dict, price_range: np.ndarray) -> list[dict]:
+        # Seul unit_price varie entre scénarios : demande = max(0, a * p + c), sans matrice de scénarios
+        a, c = self._revenue_terms(features)
+        predicted_qty = np.maximum(a * price_range + c, 0.0)
+        predicted_revenue = price_range * predicted_qty
+
+        return [
+            {'price': price, 'predicted_quantity': qty, 'predicted_revenue': revenue}
+            for price, qty, revenue in zip(price_range.tolist(), predicted_qty.tolist(), predicted_revenue.tolist())
+        ]
 
-        if len(df) < 2:
+    def calculate_elasticity(self, price_data: list[dict]) -> float:
+        if len(price_data) < 2:
             return -1.0
 
-        price_change = (df['unit_price'].iloc[-1] - df['unit_price'].iloc[0]) / df['unit_price'].iloc[0]
-        qty_change = (df['qty'].iloc[-1] - df['qty'].iloc[0]) / df['qty'].iloc[0]
+        first, last = price_data[0], price_data[-1]
+        p0, q0 = first['unit_price'], first['qty']
+
+        # Prix initial nul : variation relative non définie
+        if p0 == 0:
+            return 0.0
+
+        price_change = (last['unit_price'] - p0) / p0
 
         # Si la variation de prix est nulle, l’élasticité est indéfinie
-        if abs(price_change) < 1e-6 or df['qty'].iloc[0] == 0:
+        if abs(price_change) < 1e-6 or q0 == 0:
             return 0.0
 
+        qty_change = (last['qty'] - q0) / q0
         elasticity = qty_change / price_change
         return float(elasticity)
@@ -0,0 +1,28 @@
+import httpx
+from postgrest.utils import SyncClient
+from supabase import create_client, Client
+from supabase.lib.client_options import ClientOptions
+
+POSTGREST_TIMEOUT_SECONDS = 30
+
+# Sized for the ingestion thread pool and concurrent API requests
+POSTGREST_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+
+def create_pooled_client(supabase_url: str, supabase_key: str) -> Client:
+    client = create_client(supabase_url, supabase_key,
+                           options=ClientOptions(postgrest_client_timeout=POSTGREST_TIMEOUT_SECONDS))
+
+    # Replace the default PostgREST session with one that keeps connections alive in a
+    # larger pool and multiplexes concurrent requests over HTTP/2
+    rest = client.postgrest
+    default_session = rest.session
+    rest.session = SyncClient(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        timeout=default_session.timeout,
+        limits=POSTGREST_LIMITS,
+        http2=True,
+    )
+    default_session.close()
+    return client
@@ -16,34 +16,19 @@ export function Dashboard() {
 
   const loadSummary = async () => {
     try {
-      const { data: productsData } = await supabase
-        .from("products")
-        .select("id", { count: "exact" });
-
-      const { data: priceData } = await supabase
-        .from("price_history")
-        .select("total_price, unit_price");
-
-      const totalProducts = productsData?.length || 0;
-      const totalRecords = priceData?.length || 0;
-      const totalRevenue =
-        priceData?.reduce(
-          (sum, record) => sum + (record.total_price || 0),
-          0
-        ) || 0;
-      const avgPrice =
-        priceData && priceData.length > 0
-          ? priceData.reduce(
-              (sum, record) => sum + (record.unit_price || 0),
-              0
-            ) / priceData.length
-          : 0;
+      // Aggregated in PostgreSQL (analytics_summary) instead of summing every row here
+      const { data: summaryData, error: summaryError } = await supabase
+        .rpc("analytics_summary")
+        .single();
+      if (summaryError) throw summaryError;
 
       setSummary({
-        total_products: totalProducts,
-        total_records: totalRecords,
-        total_revenue: Math.round(totalRevenue * 100) / 100,
-        average_price: Math.round(avgPrice * 100) / 100,
+        total_products: Number(summaryData.total_products) || 0,
+        total_records: Number(summaryData.total_records) || 0,
+        total_revenue:
+          Math.round((Number(summaryData.total_revenue) || 0) * 100) / 100,
+        average_price:
+          Math.round((Number(summaryData.average_price) || 0) * 100) / 100,
       });
 
       // Discover dataset temporal coverage (first and last records)
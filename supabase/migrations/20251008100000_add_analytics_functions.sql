@@ -0,0 +1,33 @@
+-- Server-side aggregations used by the API so summary endpoints return a
+-- single row instead of transferring whole tables
+
+create or replace function public.analytics_summary()
+returns table (
+  total_products bigint,
+  total_records bigint,
+  total_revenue numeric,
+  average_price numeric
+)
+language sql
+stable
+as $$
+  select
+    (select count(*) from public.products),
+    count(*),
+    coalesce(sum(total_price), 0),
+    coalesce(avg(unit_price), 0)
+  from public.price_history;
+$$;
+
+create or replace function public.product_categories()
+returns table (product_category_name text)
+language sql
+stable
+as $$
+  select distinct p.product_category_name
+  from public.products p
+  order by p.product_category_name;
+$$;
+
+grant execute on function public.analytics_summary() to anon, authenticated;
+grant execute on function public.product_categories() to anon, authenticated;
@@ -0,0 +1,24 @@
+-- Persisted demand models so the API can skip retraining after a restart
+
+create table if not exists public.product_models (
+  product_id uuid primary key references public.products(id) on delete cascade,
+  -- sha1 of the full price_history the model was trained on
+  fingerprint text not null,
+  model jsonb not null,
+  summary jsonb not null
+);
+
+alter table public.product_models enable row level security;
+
+create policy "Anyone can view product models"
+  on public.product_models for select
+  using (true);
+
+create policy "Allow all inserts on product_models"
+  on public.product_models for insert
+  with check (true);
+
+create policy "Allow all updates on product_models"
+  on public.product_models for update
+  using (true)
+  with check (true);